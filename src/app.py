@@ -5,20 +5,65 @@ A super simple FastAPI application that allows students to view and sign up
 for extracurricular activities at Mergington High School.
 """
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import RedirectResponse
+from fastapi.responses import Response
+import hashlib
+import orjson
 import os
+import queue
+import re
 import sqlite3
+import threading
+import uuid
+from contextlib import asynccontextmanager, closing, contextmanager
+from itertools import groupby
+from operator import itemgetter
 from pathlib import Path
+from typing import Iterator
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Runs once per worker process, after any reload, rather than on every import
+    init_db()
+    _open_pools()
+    yield
+    _close_pools()
+
 
 app = FastAPI(title="Mergington High School API",
-              description="API for viewing and signing up for extracurricular activities")
+              description="API for viewing and signing up for extracurricular activities",
+              lifespan=lifespan)
+
+
+class CachedStaticFiles(StaticFiles):
+    """StaticFiles that lets browsers cache assets between page loads"""
+
+    # Asset file names are not content-hashed, so keep lifetimes short enough
+    # for a redeploy to reach clients; ETag/Last-Modified handle revalidation
+    asset_cache_control = "public, max-age=86400"
+    html_cache_control = "no-cache"
+
+    async def get_response(self, path, scope):
+        response = await super().get_response(path, scope)
+        if response.status_code in (200, 304):
+            if path.endswith(".html"):
+                response.headers["Cache-Control"] = self.html_cache_control
+            else:
+                response.headers["Cache-Control"] = self.asset_cache_control
+        return response
+
 
 # Mount the static files directory
 current_dir = Path(__file__).parent
-app.mount("/static", StaticFiles(directory=os.path.join(Path(__file__).parent,
-          "static")), name="static")
+app.mount("/static", CachedStaticFiles(directory=current_dir / "static"),
+          name="static")
+
+# The landing page is served from memory at / instead of redirecting to /static
+_INDEX_BYTES = (current_dir / "static" / "index.html").read_bytes()
+_INDEX_ETAG = f'"{hashlib.sha1(_INDEX_BYTES).hexdigest()}"'
 
 # Default activity data used to seed the database on first run
 DEFAULT_ACTIVITIES = {
@@ -78,171 +123,409 @@ DEFAULT_ACTIVITIES = {
     }
 }
 
-DB_PATH = current_dir / "activities.db"
+DB_PATH = str(current_dir / "activities.db")
+READER_POOL_SIZE = os.cpu_count() or 1
+
+# Data queries, kept in one place so every call hands
+# sqlite3 the same text and reuses the connection's cached prepared statement
+_SQL_SELECT_ACTIVITY = "SELECT 1 FROM activities WHERE name = ?"
+_SQL_SELECT_ACTIVITY_META = """
+    SELECT name, description, schedule, max_participants
+    FROM activities
+    ORDER BY name
+"""
+_SQL_SELECT_REGISTRATIONS = """
+    SELECT activity_name, email
+    FROM activity_registrations
+    ORDER BY activity_name, email
+"""
+_SQL_INSERT_REG = """
+    INSERT OR IGNORE INTO activity_registrations (activity_name, email)
+    VALUES (?, ?)
+    RETURNING 1
+"""
+_SQL_DELETE_REG = """
+    DELETE FROM activity_registrations
+    WHERE activity_name = ? AND email = ?
+    RETURNING 1
+"""
+
+# Reject malformed emails before they reach the single writer connection
+_EMAIL_RE = re.compile(r"^[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}$")
+_MAX_EMAIL_LEN = 254
+
 
+def normalize_email(email: str) -> str:
+    # Lowercase so the same address in different case hits the primary key
+    return email.strip().lower()
 
-def get_db_connection() -> sqlite3.Connection:
-    connection = sqlite3.connect(DB_PATH)
+
+def _open_connection(read_only: bool = False) -> sqlite3.Connection:
+    # Pooled connections are handed to whichever threadpool worker runs the handler.
+    # isolation_level=None: transactions are managed explicitly by the callers
+    if read_only:
+        connection = sqlite3.connect(
+            f"{Path(DB_PATH).as_uri()}?mode=ro", uri=True,
+            check_same_thread=False, isolation_level=None
+        )
+    else:
+        connection = sqlite3.connect(
+            DB_PATH, check_same_thread=False, isolation_level=None
+        )
     connection.row_factory = sqlite3.Row
+    # Per-connection settings; journal_mode=WAL is persistent and set in init_db
+    connection.execute("PRAGMA synchronous = NORMAL")
+    connection.execute("PRAGMA temp_store = MEMORY")
+    connection.execute("PRAGMA cache_size = -20000")
+    connection.execute("PRAGMA busy_timeout = 5000")
+    connection.execute("PRAGMA foreign_keys = ON")
+    if read_only:
+        connection.execute("PRAGMA query_only = 1")
     return connection
 
 
-def init_db():
-    with get_db_connection() as connection:
-        connection.execute("""
-            CREATE TABLE IF NOT EXISTS activities (
-                name TEXT PRIMARY KEY,
-                description TEXT NOT NULL,
-                schedule TEXT NOT NULL,
-                max_participants INTEGER NOT NULL
-            )
-        """)
-        connection.execute("""
-            CREATE TABLE IF NOT EXISTS activity_registrations (
-                activity_name TEXT NOT NULL,
-                email TEXT NOT NULL,
-                PRIMARY KEY (activity_name, email),
-                FOREIGN KEY (activity_name) REFERENCES activities(name) ON DELETE CASCADE
-            )
-        """)
+# Long-lived connections keep their page cache warm between requests. Under WAL
+# the readers never block on the writer, and all writes are serialized through
+# the single writer connection.
+_reader_pool: queue.Queue = queue.Queue()
+_writer_pool: queue.Queue = queue.Queue(maxsize=1)
+# Every connection the pools own, including ones currently checked out
+_pooled_connections: list[sqlite3.Connection] = []
+POOL_TIMEOUT = 30
+
+
+def _open_pools():
+    global _data_version_connection
+    # Readers open the database read-only, so it must already exist (see init_db)
+    writer = _open_connection()
+    _pooled_connections.append(writer)
+    _writer_pool.put(writer)
+    for _ in range(READER_POOL_SIZE):
+        reader = _open_connection(read_only=True)
+        _pooled_connections.append(reader)
+        _reader_pool.put(reader)
+    _data_version_connection = _open_connection(read_only=True)
+    # The watcher is queried from the event loop, so it must never wait on a lock
+    _data_version_connection.execute("PRAGMA busy_timeout = 0")
+    _pooled_connections.append(_data_version_connection)
+
+
+def _close_pools():
+    global _data_version_connection
+    for pool in (_reader_pool, _writer_pool):
+        while not pool.empty():
+            pool.get_nowait()
+    with _activities_cache_lock:
+        _data_version_connection = None
+    for connection in _pooled_connections:
+        connection.close()
+    _pooled_connections.clear()
+
+
+@contextmanager
+def _checkout(pool: queue.Queue) -> Iterator[sqlite3.Connection]:
+    if not _pooled_connections:
+        raise RuntimeError("database pools not open")
+    try:
+        connection = pool.get(timeout=POOL_TIMEOUT)
+    except queue.Empty:
+        raise RuntimeError("timed out waiting for a database connection") from None
+    try:
+        yield connection
+    finally:
+        # A connection closed by _close_pools while checked out is not returned
+        if connection in _pooled_connections:
+            pool.put(connection)
+
+
+def get_reader():
+    return _checkout(_reader_pool)
+
+
+def get_writer():
+    return _checkout(_writer_pool)
+
+
+@contextmanager
+def immediate_transaction(connection: sqlite3.Connection) -> Iterator[sqlite3.Connection]:
+    # Take the write lock up front instead of upgrading a read lock mid-transaction,
+    # which can fail with SQLITE_BUSY when another writer gets there first
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        yield connection
+        connection.execute("COMMIT")
+    except BaseException:
+        # SQLite may already have rolled back on its own (e.g. SQLITE_FULL), and a
+        # failed COMMIT can leave the transaction open; never hand back a
+        # connection mid-transaction
+        if connection.in_transaction:
+            connection.execute("ROLLBACK")
+        raise
+
+
+# Activity details never change after seeding, so they are read once by init_db
+# and only the participant lists are queried per request
+_ACTIVITY_META: dict = {}
 
-        existing_activity_count = connection.execute(
-            "SELECT COUNT(*) FROM activities"
-        ).fetchone()[0]
 
-        if existing_activity_count == 0:
-            for activity_name, activity in DEFAULT_ACTIVITIES.items():
-                connection.execute(
+def init_db():
+    with closing(_open_connection()) as connection:
+        # journal_mode cannot be changed inside a transaction
+        connection.execute("PRAGMA journal_mode = WAL")
+        with immediate_transaction(connection):
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS activities (
+                    name TEXT PRIMARY KEY,
+                    description TEXT NOT NULL,
+                    schedule TEXT NOT NULL,
+                    max_participants INTEGER NOT NULL
+                )
+            """)
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS activity_registrations (
+                    activity_name TEXT NOT NULL,
+                    email TEXT NOT NULL,
+                    PRIMARY KEY (activity_name, email),
+                    FOREIGN KEY (activity_name) REFERENCES activities(name) ON DELETE CASCADE
+                )
+            """)
+            # The primary key's (activity_name, email) order already serves lookups
+            # by activity; this index covers lookups by student
+            connection.execute("""
+                CREATE INDEX IF NOT EXISTS idx_reg_email
+                ON activity_registrations (email)
+            """)
+
+            existing_activity_count = connection.execute(
+                "SELECT COUNT(*) FROM activities"
+            ).fetchone()[0]
+
+            if existing_activity_count == 0:
+                connection.executemany(
                     """
                     INSERT INTO activities (name, description, schedule, max_participants)
                     VALUES (?, ?, ?, ?)
                     """,
-                    (
-                        activity_name,
-                        activity["description"],
-                        activity["schedule"],
-                        activity["max_participants"],
-                    )
+                    [
+                        (
+                            activity_name,
+                            activity["description"],
+                            activity["schedule"],
+                            activity["max_participants"],
+                        )
+                        for activity_name, activity in DEFAULT_ACTIVITIES.items()
+                    ]
                 )
-                for email in activity["participants"]:
-                    connection.execute(
-                        """
-                        INSERT INTO activity_registrations (activity_name, email)
-                        VALUES (?, ?)
-                        """,
+                connection.executemany(
+                    """
+                    INSERT INTO activity_registrations (activity_name, email)
+                    VALUES (?, ?)
+                    """,
+                    [
                         (activity_name, email)
-                    )
-
-
-def load_activities() -> dict:
-    with get_db_connection() as connection:
-        activity_rows = connection.execute(
-            """
-            SELECT name, description, schedule, max_participants
-            FROM activities
-            ORDER BY name
-            """
-        ).fetchall()
-
-        registrations = connection.execute(
-            """
-            SELECT activity_name, email
-            FROM activity_registrations
-            ORDER BY activity_name, email
-            """
-        ).fetchall()
-
-    participants_by_activity = {}
-    for registration in registrations:
-        participants_by_activity.setdefault(registration["activity_name"], []).append(
-            registration["email"]
-        )
+                        for activity_name, activity in DEFAULT_ACTIVITIES.items()
+                        for email in activity["participants"]
+                    ]
+                )
 
-    activities = {}
+            # Registrations saved before emails were normalized may hold mixed-case
+            # or padded addresses; fold them to the canonical form and drop any
+            # that collide with an existing canonical row. SQLite's lower()/trim()
+            # only handle ASCII and spaces, so use the same function as the handlers
+            connection.create_function(
+                "normalize_email", 1, normalize_email, deterministic=True
+            )
+            connection.execute("""
+                UPDATE OR IGNORE activity_registrations
+                SET email = normalize_email(email)
+                WHERE email != normalize_email(email)
+            """)
+            connection.execute("""
+                DELETE FROM activity_registrations
+                WHERE email != normalize_email(email)
+            """)
+
+            # Refresh planner statistics for the pooled connections opened afterwards
+            connection.execute("ANALYZE")
+
+        activity_rows = connection.execute(_SQL_SELECT_ACTIVITY_META).fetchall()
+
+    _ACTIVITY_META.clear()
     for row in activity_rows:
-        activities[row["name"]] = {
+        _ACTIVITY_META[row["name"]] = {
             "description": row["description"],
             "schedule": row["schedule"],
             "max_participants": row["max_participants"],
-            "participants": participants_by_activity.get(row["name"], []),
         }
 
-    return activities
+
+def load_activities() -> dict:
+    with get_reader() as connection:
+        registrations = connection.execute(_SQL_SELECT_REGISTRATIONS).fetchall()
+
+    # Rows arrive sorted by activity, so each group is one activity's participants
+    participants_by_activity = {
+        activity_name: [registration["email"] for registration in group]
+        for activity_name, group in groupby(registrations, key=itemgetter("activity_name"))
+    }
+
+    return {
+        name: {**meta, "participants": participants_by_activity.get(name, [])}
+        for name, meta in _ACTIVITY_META.items()
+    }
+
+
+# In-process cache of the serialized /activities payload and its ETag. Writes bump
+# the version so a load that raced with a write never repopulates the cache with
+# stale data.
+_activities_payload: tuple[bytes, str] | None = None
+_activities_version = 0
+_activities_cache_lock = threading.Lock()
+
+# Commits made by other worker processes never reach invalidate_activities_cache,
+# so a dedicated connection watches PRAGMA data_version, which changes whenever
+# any other connection commits
+_data_version_connection: sqlite3.Connection | None = None
+_seen_data_version: int | None = None
+
+# The version counter restarts with the process, so tag ETags with a per-process
+# id to keep clients from revalidating against data from a previous run
+_BOOT_ID = uuid.uuid4().hex
+
+
+def activities_etag(version: int) -> str:
+    return f'W/"{_BOOT_ID}-{version}"'
+
+
+def get_activities_payload() -> tuple[bytes, str]:
+    global _activities_payload
+    with _activities_cache_lock:
+        if _activities_payload is not None:
+            return _activities_payload
+        version = _activities_version
+
+    payload = (orjson.dumps(load_activities()), activities_etag(version))
+    with _activities_cache_lock:
+        if version == _activities_version:
+            _activities_payload = payload
+    return payload
 
 
-init_db()
+def _read_data_version() -> int | None:
+    # None means the version is unknown, which callers treat as changed
+    if _data_version_connection is None:
+        return None
+    try:
+        return _data_version_connection.execute("PRAGMA data_version").fetchone()[0]
+    except sqlite3.OperationalError:
+        return None
+
+
+def sync_activities_cache():
+    global _activities_payload, _activities_version, _seen_data_version
+    with _activities_cache_lock:
+        data_version = _read_data_version()
+        if data_version is None or data_version != _seen_data_version:
+            _seen_data_version = data_version
+            _activities_version += 1
+            _activities_payload = None
+
+
+def invalidate_activities_cache():
+    global _activities_payload, _activities_version, _seen_data_version
+    with _activities_cache_lock:
+        # Absorb the data_version change from our own commit so the next
+        # sync_activities_cache does not bump the version a second time
+        _seen_data_version = _read_data_version()
+        _activities_version += 1
+        _activities_payload = None
 
 
 @app.get("/")
-def root():
-    return RedirectResponse(url="/static/index.html")
+def root(request: Request):
+    headers = {"ETag": _INDEX_ETAG, "Cache-Control": "public, max-age=60"}
+    if request.headers.get("if-none-match") == _INDEX_ETAG:
+        return Response(status_code=304, headers=headers)
+    return Response(content=_INDEX_BYTES, media_type="text/html", headers=headers)
 
 
 @app.get("/activities")
-def get_activities():
-    return load_activities()
+async def get_activities(request: Request):
+    # PRAGMA data_version opens a brief read transaction (re-reading page 1 after a
+    # commit). The watcher has busy_timeout = 0, so a busy database invalidates
+    # the cache instead of stalling the event loop
+    sync_activities_cache()
+
+    # Clients holding the current version get a 304 without touching the cache or SQLite
+    current_etag = activities_etag(_activities_version)
+    if request.headers.get("if-none-match") == current_etag:
+        return Response(
+            status_code=304,
+            headers={"ETag": current_etag, "Cache-Control": "no-cache"}
+        )
+
+    # Cache hits are served straight from the event loop; only a miss needs a
+    # worker thread for the blocking SQLite read
+    payload = _activities_payload
+    if payload is None:
+        payload = await run_in_threadpool(get_activities_payload)
+    activities_json, etag = payload
+    return Response(
+        content=activities_json,
+        media_type="application/json",
+        headers={"ETag": etag, "Cache-Control": "no-cache"}
+    )
 
 
 @app.post("/activities/{activity_name}/signup")
 def signup_for_activity(activity_name: str, email: str):
     """Sign up a student for an activity"""
-    with get_db_connection() as connection:
-        activity = connection.execute(
-            "SELECT name FROM activities WHERE name = ?",
-            (activity_name,)
-        ).fetchone()
-        if not activity:
-            raise HTTPException(status_code=404, detail="Activity not found")
-
-        existing_registration = connection.execute(
-            """
-            SELECT 1
-            FROM activity_registrations
-            WHERE activity_name = ? AND email = ?
-            """,
-            (activity_name, email)
-        ).fetchone()
-
-        if existing_registration:
-            raise HTTPException(
-                status_code=400,
-                detail="Student is already signed up"
-            )
-
-        connection.execute(
-            """
-            INSERT INTO activity_registrations (activity_name, email)
-            VALUES (?, ?)
-            """,
-            (activity_name, email)
+    email = normalize_email(email)
+    if len(email) > _MAX_EMAIL_LEN or not _EMAIL_RE.match(email):
+        raise HTTPException(status_code=422, detail="Invalid email address")
+
+    try:
+        with get_writer() as connection, \
+                immediate_transaction(connection):
+            # OR IGNORE covers the duplicate case; RETURNING tells us if a row went in
+            inserted = connection.execute(
+                _SQL_INSERT_REG, (activity_name, email)
+            ).fetchone()
+    except sqlite3.IntegrityError:
+        # Foreign key violations are not ignored, so this means an unknown activity
+        raise HTTPException(status_code=404, detail="Activity not found")
+
+    if not inserted:
+        raise HTTPException(
+            status_code=400,
+            detail="Student is already signed up"
         )
 
+    invalidate_activities_cache()
     return {"message": f"Signed up {email} for {activity_name}"}
 
 
 @app.delete("/activities/{activity_name}/unregister")
 def unregister_from_activity(activity_name: str, email: str):
     """Unregister a student from an activity"""
-    with get_db_connection() as connection:
-        activity = connection.execute(
-            "SELECT name FROM activities WHERE name = ?",
-            (activity_name,)
+    email = normalize_email(email)
+    with get_writer() as connection, \
+            immediate_transaction(connection):
+        deleted = connection.execute(
+            _SQL_DELETE_REG, (activity_name, email)
         ).fetchone()
-        if not activity:
-            raise HTTPException(status_code=404, detail="Activity not found")
-
-        delete_result = connection.execute(
-            """
-            DELETE FROM activity_registrations
-            WHERE activity_name = ? AND email = ?
-            """,
-            (activity_name, email)
-        )
 
-        if delete_result.rowcount == 0:
+        if not deleted:
+            activity = connection.execute(
+                _SQL_SELECT_ACTIVITY, (activity_name,)
+            ).fetchone()
+            if not activity:
+                raise HTTPException(status_code=404, detail="Activity not found")
+
             raise HTTPException(
                 status_code=400,
                 detail="Student is not signed up for this activity"
             )
 
+    invalidate_activities_cache()
     return {"message": f"Unregistered {email} from {activity_name}"}